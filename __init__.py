@@ -2,7 +2,7 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
 from trytond.pool import Pool
-from . import plan
+from . import ir, plan
 from .plan import StockMixin, StockShipmentMixin
 
 __all__ = ['StockMixin', 'StockShipmentMixin', 'register']
@@ -11,13 +11,17 @@ __all__ = ['StockMixin', 'StockShipmentMixin', 'register']
 def register():
     Pool.register(
         plan.StockPlan,
+        plan.StockPlanProgress,
         plan.StockPlanLine,
+        plan.StockPlanLineEnd,
+        plan.StockLocation,
         plan.StockMove,
         plan.StockShipmentIn,
         plan.StockShipmentInReturn,
         plan.StockShipmentOut,
         plan.StockShipmentOutReturn,
         plan.StockShipmentInternal,
+        ir.Cron,
         module='stock_plan', type_='model')
     Pool.register(
         module='stock_plan', type_='wizard')
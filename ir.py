@@ -0,0 +1,16 @@
+# This file is part stock_plan module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from trytond.pool import PoolMeta
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.extend([
+                ('stock.plan|calculate_plans', "Calculate Stock Plans"),
+                ('stock.plan|purge_plans', "Purge Deprecated Stock Plans"),
+                ])
@@ -1,13 +1,31 @@
-from datetime import datetime
-from collections import defaultdict
-
-from trytond.model import ModelSQL, ModelView, fields, Workflow
+from datetime import datetime, timedelta
+import csv
+import gzip
+import multiprocessing
+import os
+import sys
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby, islice
+from operator import itemgetter
+
+from sql import Cast, Column, Literal, Null, NullsLast, Select, Union
+from sql.aggregate import Max, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import CurrentTimestamp
+from sql.operators import Concat
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond import config
+from trytond.model import Index, ModelSQL, ModelView, fields, Workflow
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, In, Not
 from trytond.transaction import Transaction
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
 from trytond.pyson import PYSONEncoder
+from trytond.tools import grouped_slice
 
 
 class StockPlan(Workflow, ModelSQL, ModelView):
@@ -29,39 +47,49 @@ class StockPlan(Workflow, ModelSQL, ModelView):
     computed_at = fields.DateTime('Computed At',
         help='The last time the plan was calculated.',
         readonly=True)
+    calculating = fields.Boolean('Calculating', readonly=True,
+        help='If checked, the plan is being calculated in the background.')
+    processed_keys = fields.Function(fields.Integer('Processed Keys',
+            help='Number of warehouse and product pairs already allocated.'),
+        'get_progress')
+    total_keys = fields.Function(fields.Integer('Total Keys',
+            help='Number of warehouse and product pairs to allocate.'),
+        'get_progress')
+    elapsed_time = fields.Function(fields.TimeDelta('Elapsed Time',
+            help='The time spent allocating on the last calculation.'),
+        'get_progress')
     lines = fields.One2Many('stock.plan.line', 'plan', 'Lines',
         states={
             'readonly': Not(In(Eval('state'), ['draft', 'active']))
             })
+    purged_at = fields.DateTime('Purged At', readonly=True,
+        help='When the lines of the deprecated plan were removed.')
+    archive_path = fields.Char('Archive Path', readonly=True,
+        help='The file where the lines were archived before being removed.')
+    end_lines_computed = fields.Boolean('End Lines Computed', readonly=True,
+        help='If checked, the final and initial lines of each line were '
+            'stored on activation.')
     state = fields.Selection([
         ('draft', 'Draft'),
         ('active', 'Active'),
         ('deprecated', 'Deprecated'),
         ('cancelled', 'Cancelled'),
     ], 'State', required=True, readonly=True)
-    valid_lines = fields.Function(
-        fields.Integer('Valid Lines',
-            help='Number of lines that have both a source and a destination, '
-                'where the source is not delayed.'),
-        'get_lines_count')
-    excess_stock = fields.Function(
-        fields.Integer('Excess Stock',
-            help='Number of lines without a destination.',
-            states={
-                'invisible': ~Eval('include_excess_stock', True)
-                }),
-        'get_lines_count')
-    late_stock = fields.Function(
-        fields.Integer('Late Stock',
-            help='Number of lines that have both a source and a destination, '
-                'but where the source is delayed.'),
-        'get_lines_count')
-    total_lines = fields.Function(
-        fields.Integer('Total Lines'), 'get_lines_count')
-    without_stock = fields.Function(
-        fields.Integer('Without Stock',
-            help='Number of lines without a source.'),
-        'get_lines_count')
+    valid_lines = fields.Integer('Valid Lines', readonly=True,
+        help='Number of lines that have both a source and a destination, '
+            'where the source is not delayed.')
+    excess_stock = fields.Integer('Excess Stock', readonly=True,
+        help='Number of lines without a destination.',
+        states={
+            'invisible': ~Eval('include_excess_stock', True)
+            })
+    late_stock = fields.Integer('Late Stock', readonly=True,
+        help='Number of lines that have both a source and a destination, '
+            'but where the source is delayed.')
+    total_lines = fields.Integer('Total Lines', readonly=True)
+    without_stock = fields.Integer('Without Stock', readonly=True,
+        help='Number of lines without a source.')
+    _active_plan_cache = Cache('stock.plan.active_plan', context=False)
 
     @classmethod
     def __setup__(cls):
@@ -95,10 +123,48 @@ class StockPlan(Workflow, ModelSQL, ModelView):
             },
             'calculate': {
                 'icon': 'tryton-refresh',
-                'invisible': Eval('state') != 'draft',
+                'invisible': ((Eval('state') != 'draft')
+                    | Eval('calculating', False)),
+                'depends': ['state', 'calculating'],
+            },
+            'calculate_changes': {
+                'icon': 'tryton-refresh',
+                'invisible': ((Eval('state') != 'draft')
+                    | ~Eval('computed_at')
+                    | Eval('calculating', False)),
+                'depends': ['state', 'computed_at', 'calculating'],
+            },
+            'reset_calculation': {
+                'icon': 'tryton-clear',
+                'invisible': ~Eval('calculating', False),
+                'depends': ['calculating'],
+            },
+            'purge': {
+                'icon': 'tryton-delete',
+                'invisible': ((Eval('state') != 'deprecated')
+                    | Eval('purged_at')),
+                'depends': ['state', 'purged_at'],
             },
         })
 
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        table_h = cls.__table_handler__(module_name)
+        fill_lines_count = not table_h.column_exist('total_lines')
+
+        super().__register__(module_name)
+
+        # Migration from 8.0: store lines count
+        # The new columns are filled with the defaults, so they are cleared
+        # to be counted once the lines are migrated by stock.plan.line
+        if fill_lines_count:
+            cursor.execute(*table.update(
+                    [Column(table, n) for n in cls._lines_count_fields()],
+                    [Null] * len(cls._lines_count_fields())))
+
     @staticmethod
     def default_company():
         transaction = Transaction()
@@ -108,50 +174,144 @@ class StockPlan(Workflow, ModelSQL, ModelView):
     def default_state():
         return 'draft'
 
+    @staticmethod
+    def default_calculating():
+        return False
+
+    @staticmethod
+    def default_end_lines_computed():
+        return False
+
+    @staticmethod
+    def default_valid_lines():
+        return 0
+
+    @staticmethod
+    def default_excess_stock():
+        return 0
+
+    @staticmethod
+    def default_late_stock():
+        return 0
+
+    @staticmethod
+    def default_total_lines():
+        return 0
+
+    @staticmethod
+    def default_without_stock():
+        return 0
+
     @classmethod
-    def get_lines_count(cls, plans, names):
-        pool = Pool()
-        StockPlanLine = pool.get('stock.plan.line')
+    def copy(cls, plans, default=None):
+        if default is None:
+            default = {}
+        else:
+            default = default.copy()
+        default.setdefault('end_lines_computed', False)
+        default.setdefault('purged_at', None)
+        default.setdefault('archive_path', None)
+        return super().copy(plans, default=default)
 
-        result = {}
-        for name in names:
-            result[name] = {}
-            for plan in plans:
-                result[name][plan.id] = 0
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        args = []
+        for plans, values in zip(actions, actions):
+            # The lines no longer match the plan options
+            if 'include_excess_stock' in values:
+                values = values.copy()
+                values['computed_at'] = None
+            args.extend((plans, values))
+        super().write(*args)
 
-                if name == 'valid_lines':
-                    result[name][plan.id] = StockPlanLine.search_count([
-                        ('plan', '=', plan.id),
-                        ('source', '!=', None),
-                        ('destination', '!=', None),
-                        ['OR',
-                            ('day_difference', '>', 0),
-                            ('source', 'like', 'stock.location,%'),
-                        ]
-                    ])
-                if name == 'excess_stock':
-                    result[name][plan.id] = StockPlanLine.search_count([
-                        ('plan', '=', plan.id),
-                        ('destination', '=', None),
-                    ])
-                if name == 'late_stock':
-                    result[name][plan.id] = StockPlanLine.search_count([
-                        ('plan', '=', plan.id),
-                        ('source', 'like', 'stock.move,%'),
-                        ('destination', '!=', None),
-                        ['OR',
-                            ('day_difference', '=', None),
-                            ('day_difference', '<', '0'),
-                        ]
-                    ])
-                if name == 'total_lines':
-                    result[name][plan.id] = len(plan.lines)
-                if name == 'without_stock':
-                    result[name][plan.id] = StockPlanLine.search_count([
-                        ('plan', '=', plan.id),
-                        ('source', '=', None),
-                    ])
+    @classmethod
+    def on_modification(cls, mode, plans, field_names=None):
+        super().on_modification(mode, plans, field_names=field_names)
+        if (mode != 'write'
+                or field_names is None
+                or not {'state', 'company'}.isdisjoint(field_names)):
+            cls._active_plan_cache.clear()
 
+    @classmethod
+    def get_active_plan(cls, company_id):
+        "Return the id of the active plan of the company or None"
+        plan_id = cls._active_plan_cache.get(company_id, -1)
+        if plan_id != -1:
+            return plan_id
+        plans = cls.search([
+                ('state', '=', 'active'),
+                ('company', '=', company_id),
+                ], limit=1)
+        plan_id = plans[0].id if plans else None
+        cls._active_plan_cache.set(company_id, plan_id)
+        return plan_id
+
+    @staticmethod
+    def _lines_count_fields():
+        return ['valid_lines', 'excess_stock', 'late_stock', 'total_lines',
+            'without_stock']
+
+    @classmethod
+    def update_lines_count(cls, plan_ids):
+        "Store the lines count fields of the plans computed from their lines"
+        to_write = []
+        for plan_id, values in cls._count_lines(list(plan_ids)).items():
+            to_write.extend(([cls(plan_id)], values))
+        if to_write:
+            cls.write(*to_write)
+
+    @classmethod
+    def clear_end_lines(cls, plan_ids):
+        """
+        Mark the stored end lines of the plans as outdated so they are
+        computed from the lines until the plans are activated again.
+        """
+        plans = cls.search([
+                ('id', 'in', list(plan_ids)),
+                ('end_lines_computed', '=', True),
+                ])
+        if plans:
+            cls.write(plans, {'end_lines_computed': False})
+
+    @classmethod
+    def _count_lines(cls, plan_ids):
+        """
+        Return for each plan id a dictionary with the values of the lines
+        count fields computed with a single grouped query.
+        """
+        pool = Pool()
+        StockPlanLine = pool.get('stock.plan.line')
+
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        line = StockPlanLine.__table__()
+
+        day_difference = line.day_difference
+        from_location = line.source.like('stock.location,%')
+        from_move = line.source.like('stock.move,%')
+        conditions = {
+            'valid_lines': ((line.source != Null)
+                & (line.destination != Null)
+                & ((day_difference > 0) | from_location)),
+            'excess_stock': line.destination == Null,
+            'late_stock': (from_move
+                & (line.destination != Null)
+                & ((day_difference == Null) | (day_difference < 0))),
+            'total_lines': Literal(True),
+            'without_stock': line.source == Null,
+            }
+        names = cls._lines_count_fields()
+
+        result = {i: dict.fromkeys(names, 0) for i in plan_ids}
+        for sub_ids in grouped_slice(plan_ids, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*line.select(
+                    line.plan,
+                    *[Sum(Case((conditions[n], 1), else_=0)) for n in names],
+                    where=fields.SQL_OPERATORS['in'](line.plan, list(sub_ids)),
+                    group_by=[line.plan]))
+            for plan_id, *counts in cursor:
+                result[plan_id] = dict(zip(names, counts))
         return result
 
     @classmethod
@@ -170,9 +330,42 @@ class StockPlan(Workflow, ModelSQL, ModelView):
                 gettext('stock_plan.msg_plan_without_calculation',
                     plan=', '.join(error_plans)))
 
-        active_plans = cls.search([('state', '=', 'active')])
+        active_plans = cls.search([
+                ('state', '=', 'active'),
+                ('company', 'in', [p.company.id for p in plans]),
+                ])
         cls.deprecate(active_plans)
 
+        if config.getboolean('stock_plan', 'end_lines', default=False):
+            cls.compute_end_lines(plans)
+
+    @classmethod
+    def compute_end_lines(cls, plans):
+        """
+        Store the final and initial lines of each line of the plans so the
+        traceability fields are answered with a lookup.
+        """
+        pool = Pool()
+        StockMove = pool.get('stock.move')
+        StockPlanLine = pool.get('stock.plan.line')
+        StockPlanLineEnd = pool.get('stock.plan.line.end')
+
+        for plan in plans:
+            StockPlanLineEnd.delete(StockPlanLineEnd.search([
+                        ('plan', '=', plan.id),
+                        ]))
+            with Transaction().set_context(
+                    active_model='stock.plan', stock_plan=plan.id):
+                lines = StockPlanLine.search([('plan', '=', plan.id)])
+                for direction, name in StockPlanLineEnd._directions():
+                    ends = get_end_lines(
+                        StockMove._get_next_lines(lines, name))
+                    StockPlanLineEnd.bulk_insert(plan, (
+                            (l.id, e, direction)
+                            for l in lines
+                            for e in ends[l.id]))
+        cls.write(plans, {'end_lines_computed': True})
+
     @classmethod
     @ModelView.button
     @Workflow.transition('cancelled')
@@ -185,6 +378,25 @@ class StockPlan(Workflow, ModelSQL, ModelView):
     def deprecate(cls, plans):
         pass
 
+    @classmethod
+    @ModelView.button
+    def purge(cls, plans):
+        """
+        Remove the lines of the deprecated plans with a single query per plan.
+
+        The plans and their lines counters are kept for audit.
+        """
+        pool = Pool()
+        StockPlanLine = pool.get('stock.plan.line')
+
+        plans = [p for p in plans if p.state == 'deprecated']
+        for plan in plans:
+            StockPlanLine.bulk_delete(plan)
+        cls.write(plans, {
+                'purged_at': datetime.now(),
+                'end_lines_computed': False,
+                })
+
     @classmethod
     @ModelView.button
     @Workflow.transition('draft')
@@ -194,15 +406,418 @@ class StockPlan(Workflow, ModelSQL, ModelView):
     @classmethod
     @ModelView.button
     def calculate(cls, plans):
-        for plan in plans:
-            cls._calculate(plan)
+        plans = [p for p in plans if not p.calculating]
+        if plans:
+            cls.write(plans, {'calculating': True})
+            cls.__queue__.process_calculation(plans)
+
+    @classmethod
+    @ModelView.button
+    def calculate_changes(cls, plans):
+        plans = [p for p in plans if not p.calculating]
+        if plans:
+            cls.write(plans, {'calculating': True})
+            cls.__queue__.process_calculation(plans, changes=True)
+
+    @classmethod
+    @ModelView.button
+    def reset_calculation(cls, plans):
+        """
+        Clear the calculating flag of plans whose calculation did not finish,
+        like when its worker was killed, so they can be calculated again.
+        """
+        cls.write(plans, {'calculating': False})
 
     @classmethod
-    def _calculate(cls, plan):
+    def process_calculation(cls, plans, changes=False, activate=False):
+        transaction = Transaction()
+        try:
+            for plan in plans:
+                keys = cls._get_changed_keys(plan) if changes else None
+                if keys is None:
+                    cls._calculate(plan)
+                elif keys:
+                    cls._calculate(plan, keys)
+                else:
+                    plan.computed_at = cls._get_database_now()
+                plan.calculating = False
+                cls.save([plan])
+                if activate:
+                    cls.activate([plan])
+        except backend.DatabaseOperationalError:
+            # The task is retried
+            raise
+        except Exception:
+            # Release the locks of the failed calculation before resetting
+            # the flag in a transaction that is committed
+            transaction.rollback()
+            with transaction.new_transaction():
+                cls.write(cls.browse([p.id for p in plans]), {
+                        'calculating': False,
+                        })
+            raise
+
+    @classmethod
+    def calculate_plans(cls):
+        """
+        Create a new plan for each company whose moves changed since its
+        active plan was computed and queue its calculation and activation.
+
+        The calculation is queued so that it runs once the new plan is
+        committed.
+        """
+        pool = Pool()
+        Company = pool.get('company.company')
+
+        transaction = Transaction()
+        for company in Company.search([]):
+            with transaction.set_context(company=company.id):
+                # The previous calculation is still running
+                if cls.search([
+                            ('company', '=', company.id),
+                            ('state', '=', 'draft'),
+                            ('calculating', '=', True),
+                            ], limit=1):
+                    continue
+                active_plans = cls.search([
+                        ('company', '=', company.id),
+                        ('state', '=', 'active'),
+                        ], limit=1)
+                if active_plans:
+                    active_plan, = active_plans
+                    if cls._get_changed_keys(active_plan) == set():
+                        continue
+                    include_excess_stock = active_plan.include_excess_stock
+                else:
+                    include_excess_stock = False
+                plan = cls(
+                    company=company,
+                    include_excess_stock=include_excess_stock,
+                    calculating=True)
+                plan.save()
+                cls.__queue__.process_calculation([plan], activate=True)
+
+    @classmethod
+    def purge_plans(cls):
+        """
+        Archive and purge the lines of the deprecated plans of each company
+        older than the last ones kept by the stock_plan keep_deprecated
+        option of the configuration.
+        """
+        pool = Pool()
+        Company = pool.get('company.company')
+
+        keep = config.getint('stock_plan', 'keep_deprecated', default=None)
+        if keep is None:
+            return
+
+        to_purge = []
+        for company in Company.search([]):
+            plans = cls.search([
+                    ('company', '=', company.id),
+                    ('state', '=', 'deprecated'),
+                    ], order=[('id', 'DESC')])
+            to_purge.extend(p for p in plans[keep:] if not p.purged_at)
+        for plan in to_purge:
+            plan.archive_path = cls.archive_lines(plan)
+        cls.save(to_purge)
+        cls.purge(to_purge)
+
+    @classmethod
+    def archive_lines(cls, plan):
+        """
+        Write the lines of the plan to a gzip compressed CSV file in the
+        directory of the stock_plan archive_path option of the configuration
+        and return its path.
+        """
+        pool = Pool()
+        StockPlanLine = pool.get('stock.plan.line')
+
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        line = StockPlanLine.__table__()
+
+        directory = config.get('stock_plan', 'archive_path',
+            default=os.path.join(
+                config.get('database', 'path'), transaction.database.name,
+                'stock_plan'))
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, 'stock_plan_%s.csv.gz' % plan.id)
+
+        names = ['id'] + StockPlanLine._bulk_fields()
+        cursor.execute(*line.select(
+                *[Column(line, n) for n in names],
+                where=line.plan == plan.id,
+                order_by=[line.id.asc]))
+        # Write to a temporary file to never leave a partial archive
+        with gzip.open(path + '.tmp', 'wt', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(names)
+            while True:
+                rows = cursor.fetchmany(backend.MAX_QUERY_PARAMS)
+                if not rows:
+                    break
+                writer.writerows(rows)
+        os.replace(path + '.tmp', path)
+        return path
+
+    @classmethod
+    def get_progress(cls, plans, names):
+        pool = Pool()
+        Progress = pool.get('stock.plan.progress')
+
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        progress = Progress.__table__()
+
+        result = {name: {p.id: None for p in plans} for name in names}
+        for sub_plans in grouped_slice(plans, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*progress.select(
+                    Max(progress.id),
+                    where=fields.SQL_OPERATORS['in'](
+                        progress.plan, [p.id for p in sub_plans]),
+                    group_by=[progress.plan]))
+            for record in Progress.browse([i for i, in cursor]):
+                plan_id = record.plan.id
+                if 'processed_keys' in result:
+                    result['processed_keys'][plan_id] = record.processed_keys
+                if 'total_keys' in result:
+                    result['total_keys'][plan_id] = record.total_keys
+                if 'elapsed_time' in result:
+                    result['elapsed_time'][plan_id] = (
+                        record.create_date - record.started_at)
+        return result
+
+    @classmethod
+    def _update_progress(cls, plan, started_at, processed_keys, total_keys):
+        """
+        Store the progress of the calculation in its own transaction so it
+        can be read while the calculation is running.
+
+        SQLite shares its connection between transactions so committing the
+        progress would also commit the calculation. There it is stored with
+        the calculation instead.
+        """
+        pool = Pool()
+        Progress = pool.get('stock.plan.progress')
+
+        values = [{
+                'plan': plan.id,
+                'started_at': started_at,
+                'processed_keys': processed_keys,
+                'total_keys': total_keys,
+                }]
+        if backend.name == 'sqlite':
+            Progress.create(values)
+        else:
+            with Transaction().new_transaction():
+                Progress.create(values)
+
+    @classmethod
+    def _get_database_now(cls):
+        """
+        Return the start of the transaction on the clock of the database,
+        which is the one of the create and write dates.
+        """
+        cursor = Transaction().connection.cursor()
+        if backend.name == 'sqlite':
+            # The timestamp is stored as an ISO string with microseconds
+            cursor.execute(*Select([CurrentTimestamp()]))
+            now, = cursor.fetchone()
+            return datetime.fromisoformat(now)
+        cursor.execute(*Select([
+                    Cast(CurrentTimestamp(), cls.computed_at.sql_type().base),
+                    ]))
+        now, = cursor.fetchone()
+        return now
+
+    @classmethod
+    def _get_changed_keys(cls, plan):
+        """
+        Return the set of (warehouse, product) keys affected by the moves
+        created, modified or deleted since the plan was computed.
+
+        None is returned when the plan must be fully calculated.
+        """
+        pool = Pool()
+        StockLocation = pool.get('stock.location')
+        StockMove = pool.get('stock.move')
+        StockPlanLine = pool.get('stock.plan.line')
+
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        if not plan.computed_at:
+            return
+        # Moves written by transactions that started before the calculation
+        # but were committed after it are not seen by it and have an older
+        # write date
+        margin = config.getint('stock_plan', 'changes_margin', default=300)
+        computed_at = plan.computed_at - timedelta(seconds=margin)
+        # Lines computed before the warehouse was stored can not be matched
+        if StockPlanLine.search([
+                    ('plan', '=', plan.id),
+                    ('warehouse', '=', None),
+                    ], limit=1):
+            return
+
+        move = StockMove.__table__()
+        warehouses = StockLocation.get_location_warehouses()
+
+        cursor.execute(*move.select(
+                move.product, move.from_location, move.to_location,
+                where=((move.create_date >= computed_at)
+                    | (move.write_date >= computed_at))
+                & (move.company == plan.company.id)))
+        keys = set()
+        for product_id, from_location, to_location in cursor:
+            for location in (from_location, to_location):
+                warehouse = warehouses.get(location)
+                if warehouse:
+                    keys.add((warehouse, product_id))
+
+        # The previous keys of the changed moves and the keys of the lines
+        # whose moves were deleted
+        line = StockPlanLine.__table__()
+        destination = StockMove.__table__()
+        source = StockMove.__table__()
+        from_move = line.source.like('stock.move,%')
+        cursor.execute(*line
+            .join(destination, 'LEFT',
+                condition=line.destination == destination.id)
+            .join(source, 'LEFT',
+                condition=from_move & (source.id
+                    == StockPlanLine.source.sql_id(line.source, StockMove)))
+            .select(line.warehouse, line.product,
+                where=(line.plan == plan.id)
+                & (((line.destination == Null)
+                        & (line.destination_date != Null))
+                    | (from_move & (source.id == Null))
+                    | (destination.write_date >= computed_at)
+                    | (source.write_date >= computed_at)),
+                group_by=[line.warehouse, line.product]))
+        keys.update(cursor)
+        return keys
+
+    @classmethod
+    def _get_moves_query(cls, plan, products=None):
+        """
+        Return the move table, the from item and the condition of the open
+        moves of the plan's company.
+
+        If products is set, only the moves of those products are included.
+        """
         pool = Pool()
-        Date = pool.get('ir.date')
         Product = pool.get('product.product')
         StockMove = pool.get('stock.move')
+        Template = pool.get('product.template')
+
+        move = StockMove.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+
+        where = ((Coalesce(template.consumable, False) == Literal(False))
+            & ~move.state.in_(['done', 'cancelled'])
+            & (move.company == plan.company.id))
+        if products is not None:
+            where &= fields.SQL_OPERATORS['in'](move.product, list(products))
+        from_ = (move
+            .join(product, condition=move.product == product.id)
+            .join(template, condition=product.template == template.id))
+        return move, from_, where
+
+    @classmethod
+    def _get_move_keys(cls, plan, products=None):
+        """
+        Yield the distinct (product, from_warehouse, to_warehouse) of the open
+        moves of the plan's company.
+
+        If products is set, only the moves of those products are included.
+        """
+        pool = Pool()
+        StockLocation = pool.get('stock.location')
+
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        warehouses = StockLocation.get_location_warehouses()
+
+        move, from_, where = cls._get_moves_query(plan, products)
+        cursor.execute(*from_.select(
+                move.product, move.from_location, move.to_location,
+                where=where,
+                group_by=[move.product, move.from_location, move.to_location]))
+        for product_id, from_location, to_location in cursor:
+            yield (product_id,
+                warehouses.get(from_location), warehouses.get(to_location))
+
+    @classmethod
+    def _get_moves(cls, plan, products=None):
+        """
+        Yield the open moves of the plan's company as tuples of
+        (id, product, internal_quantity, date, from_warehouse, to_warehouse,
+        document) ordered by product and date.
+
+        If products is set, only the moves of those products are returned.
+        """
+        pool = Pool()
+        StockLocation = pool.get('stock.location')
+        StockPlanLine = pool.get('stock.plan.line')
+
+        transaction = Transaction()
+        if backend.name == 'postgresql':
+            # Server-side cursor to not load all the moves in memory
+            cursor = transaction.connection.cursor('stock_plan_moves')
+        else:
+            cursor = transaction.connection.cursor()
+
+        warehouses = StockLocation.get_location_warehouses()
+
+        move, from_, where = cls._get_moves_query(plan, products)
+        cursor.execute(*from_.select(
+                move.id, move.product, move.internal_quantity,
+                move.effective_date, move.planned_date,
+                move.from_location, move.to_location,
+                where=where,
+                order_by=[
+                    move.product.asc,
+                    NullsLast(move.effective_date.asc),
+                    NullsLast(move.planned_date.asc),
+                    move.id.asc,
+                    ]))
+        try:
+            while True:
+                rows = cursor.fetchmany(backend.MAX_QUERY_PARAMS)
+                if not rows:
+                    break
+                documents = StockPlanLine._get_move_documents(
+                    [r[0] for r in rows])
+                for (move_id, product_id, quantity, effective_date,
+                        planned_date, from_location, to_location) in rows:
+                    yield (move_id, product_id, quantity,
+                        effective_date or planned_date,
+                        warehouses.get(from_location),
+                        warehouses.get(to_location),
+                        documents[move_id])
+        finally:
+            cursor.close()
+
+    @classmethod
+    def _calculate(cls, plan, keys=None):
+        """
+        Compute the lines of the plan.
+
+        If keys is set, only the lines of those (warehouse, product) keys are
+        computed again and the other lines of the plan are kept.
+
+        The moves are streamed product by product and the lines are written
+        after each allocated chunk, so the memory does not grow with the
+        number of moves and lines.
+        """
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Product = pool.get('product.product')
+        Progress = pool.get('stock.plan.progress')
         StockLocation = pool.get('stock.location')
         StockPlanLine = pool.get('stock.plan.line')
 
@@ -211,149 +826,438 @@ class StockPlan(Workflow, ModelSQL, ModelView):
         warehouses = StockLocation.search([
             ('type', '=', 'warehouse')
         ])
-        moves = StockMove.search([
-            ('product.consumable', '=', False),
-            ('state', 'not in', ('done', 'cancelled')),
-            ('company', '=', plan.company.id),
-        ], order=[
-            ('effective_date', 'ASC NULLS LAST'),
-            ('planned_date', 'ASC NULLS LAST'),
-            ('id', 'ASC'),
-        ])
-        lines = []
+        warehouse_ids = {w.id for w in warehouses}
         today = Date.today()
+        computed_at = cls._get_database_now()
+
+        # Remove the progress of the previous calculations
+        Progress.delete(Progress.search([('plan', '=', plan.id)]))
 
-        outgoing = defaultdict(list)
-        incoming = defaultdict(list)
+        outgoing_keys = set()
+        incoming_keys = set()
         needed_products = defaultdict(set)
 
-        for move in moves:
-            from_warehouse = move.from_location.warehouse
-            to_warehouse = move.to_location.warehouse
+        products = None
+        if keys is not None:
+            products = {p for _, p in keys}
+            for warehouse_id, product_id in keys:
+                needed_products[warehouse_id].add(product_id)
 
+        for product_id, from_warehouse, to_warehouse in cls._get_move_keys(
+                plan, products):
             if from_warehouse == to_warehouse:
                 continue
 
-            if from_warehouse and from_warehouse != to_warehouse:
-                outgoing[from_warehouse].append(move)
+            key = (from_warehouse, product_id)
+            if from_warehouse in warehouse_ids and (keys is None
+                    or key in keys):
+                outgoing_keys.add(key)
                 if not plan.include_excess_stock:
-                    needed_products[from_warehouse.id].add(move.product.id)
-
-            if to_warehouse and from_warehouse != to_warehouse:
-                key = (to_warehouse.id, move.product.id)
-                incoming[key].append({ 'ref': move, 'quantity': move.internal_quantity })
-
-        for warehouse in warehouses:
-            products_filter = needed_products.get(warehouse.id, None)
-            if products_filter:
-                products_filter = (list(products_filter), )
-
-            with transaction.set_context(stock_date_end=today):
+                    needed_products[from_warehouse].add(product_id)
+
+            key = (to_warehouse, product_id)
+            if to_warehouse and (keys is None or key in keys):
+                incoming_keys.add(key)
+
+        # Without excess stock, only the stock of the products with outgoing
+        # moves is needed
+        if plan.include_excess_stock and keys is None:
+            stock_warehouses = list(warehouse_ids)
+            products_filter = None
+        else:
+            stock_warehouses = [
+                w for w in needed_products if w in warehouse_ids]
+            products_filter = (
+                list(set().union(*needed_products.values())),)
+        stocks = {}
+        if stock_warehouses:
+            with transaction.set_context(
+                    stock_date_end=today, company=plan.company.id):
                 stocks = Product.products_by_location(
-                    [warehouse.id],
+                    stock_warehouses,
                     with_childs=True,
                     grouping_filter=products_filter)
 
-            for key in list(stocks.keys()):
-                if stocks[key] <= 0:
-                    stocks.pop(key)
-
-            moves = outgoing[warehouse]
-            for move in moves:
-                key = (warehouse.id, move.product.id)
-                remain_quantity = move.internal_quantity
-
-                if key in stocks:
-                    quantity = min(remain_quantity, stocks[key])
-                    remain_quantity -= quantity
-                    stocks[key] -= quantity
-                    if stocks[key] <= 0:
-                        stocks.pop(key)
-
-                    lines.append(
-                        StockPlanLine(plan=plan, quantity=quantity,
-                            source=warehouse, destination=move,
-                            product=move.product,
-                            destination_date=(
-                                move.effective_date or move.planned_date
-                            )))
-
-                if remain_quantity == 0:
+        allocation_keys = outgoing_keys
+        if plan.include_excess_stock:
+            allocation_keys.update(k for k, q in stocks.items() if q > 0)
+            allocation_keys.update(incoming_keys)
+        if keys is not None:
+            allocation_keys &= keys
+
+        StockPlanLine.bulk_delete(plan, keys)
+
+        total_keys = len(allocation_keys)
+        processed_keys = 0
+        cls._update_progress(plan, computed_at, processed_keys, total_keys)
+        tasks = cls._get_allocation_tasks(
+            plan, allocation_keys, stocks, warehouse_ids, products)
+        for count, rows in cls._allocate(
+                tasks, total_keys, plan.include_excess_stock):
+            StockPlanLine.bulk_insert(plan, rows)
+            processed_keys += count
+            cls._update_progress(
+                plan, computed_at, processed_keys, total_keys)
+
+        plan.computed_at = computed_at
+        for name, value in cls._count_lines([plan.id])[plan.id].items():
+            setattr(plan, name, value)
+        cls.save([plan])
+
+    @classmethod
+    def _get_allocation_tasks(
+            cls, plan, keys, stocks, warehouse_ids, products=None):
+        """
+        Yield the (key, stock, outgoing, incoming) allocation tasks of the
+        keys.
+
+        The moves are read product by product so only the moves of the
+        current product are kept in memory. The keys without moves come
+        last.
+        """
+        remaining = set(keys)
+        for product_id, moves in groupby(
+                cls._get_moves(plan, products), key=itemgetter(1)):
+            outgoing = defaultdict(list)
+            incoming = defaultdict(list)
+            for (move_id, _, quantity, date, from_warehouse, to_warehouse,
+                    document) in moves:
+                if from_warehouse == to_warehouse:
                     continue
+                if from_warehouse in warehouse_ids:
+                    outgoing[(from_warehouse, product_id)].append(
+                        (move_id, quantity, date, document))
+                if to_warehouse:
+                    incoming[(to_warehouse, product_id)].append(
+                        Income(move_id, quantity, date, document))
+
+            for key in sorted((outgoing.keys() | incoming.keys()) & keys):
+                remaining.discard(key)
+                yield (key, max(stocks.get(key, 0), 0),
+                    outgoing.get(key, []), incoming.get(key, []))
 
-                while len(incoming[key]) > 0:
-                    if remain_quantity == 0:
+        for key in sorted(remaining):
+            yield key, max(stocks.get(key, 0), 0), [], []
+
+    @classmethod
+    def _allocate(cls, tasks, count, include_excess_stock):
+        """
+        Yield the number of tasks and their line rows by chunks.
+
+        tasks is an iterable of count tasks. The chunks contain at most the
+        stock_plan chunk_size option of the configuration tasks. They are
+        allocated by a pool of processes when the stock_plan processes option
+        is greater than 1, with a bounded number of chunks in flight.
+        """
+        processes = config.getint('stock_plan', 'processes', default=1)
+        size = config.getint('stock_plan', 'chunk_size', default=1000)
+        if processes > 1:
+            # Several chunks per process to balance products of different
+            # sizes
+            size = min(size, -(-count // (processes * 4)))
+        size = max(size, 1)
+        tasks = iter(tasks)
+        chunks = iter(lambda: list(islice(tasks, size)), [])
+
+        if processes <= 1 or count <= size:
+            for chunk in chunks:
+                yield len(chunk), allocate_chunk(chunk, include_excess_stock)
+            return
+
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(
+                max_workers=processes, mp_context=context) as executor:
+            futures = deque()
+            for chunk in chunks:
+                futures.append((len(chunk), executor.submit(
+                            allocate_chunk, chunk, include_excess_stock)))
+                if len(futures) >= processes * 2:
+                    length, future = futures.popleft()
+                    yield length, future.result()
+            while futures:
+                length, future = futures.popleft()
+                yield length, future.result()
+
+
+class Income:
+    "The quantity of an incoming move still available for allocation"
+    __slots__ = ('id', 'quantity', 'date', 'document')
+
+    def __init__(self, id, quantity, date, document=None):
+        self.id = id
+        self.quantity = quantity
+        self.date = date
+        self.document = document
+
+
+def allocate(key, stock, outgoing, incoming, include_excess_stock=False):
+    """
+    Allocate the stock and the incoming moves of a (warehouse, product) key
+    to its outgoing moves.
+
+    outgoing is a list of (move id, quantity, date, document) tuples and
+    incoming a sequence of Income, both ordered by date. Return the line rows
+    as expected by StockPlanLine.bulk_insert.
+    """
+    warehouse_id, product_id = key
+    source = f'stock.location,{warehouse_id}'
+    incoming = deque(incoming)
+    lines = []
+
+    for move_id, remain_quantity, date, document in outgoing:
+        if stock > 0:
+            quantity = min(remain_quantity, stock)
+            remain_quantity -= quantity
+            stock -= quantity
+
+            lines.append((warehouse_id, product_id, quantity, source,
+                    move_id, None, date, None, None, document))
+
+        if remain_quantity == 0:
+            continue
+
+        while incoming:
+            if remain_quantity == 0:
+                break
+            income = incoming[0]
+
+            quantity = min(remain_quantity, income.quantity)
+            remain_quantity -= quantity
+            income.quantity -= quantity
+            if income.quantity <= 0:
+                incoming.popleft()
+
+            if date and income.date:
+                day_difference = (date - income.date).days
+            else:
+                day_difference = None
+            lines.append((warehouse_id, product_id, quantity,
+                    'stock.move,%s' % income.id, move_id, income.date, date,
+                    day_difference, income.document, document))
+
+        # WITHOUT STOCK: Move without destination
+        if remain_quantity > 0:
+            lines.append((warehouse_id, product_id, remain_quantity,
+                    None, move_id, None, date, None, None, document))
+
+    if include_excess_stock:
+        # EXCESS STOCK: Remaining stock at warehouse
+        if stock > 0:
+            lines.append((warehouse_id, product_id, stock, source, None,
+                    None, None, None, None, None))
+        # EXCESS STOCK: Remaining incomes
+        lines.extend([
+            (warehouse_id, product_id, income.quantity,
+                'stock.move,%s' % income.id, None, income.date, None, None,
+                income.document, None)
+            for income in incoming
+        ])
+    return lines
+
+
+def get_end_lines(next_lines):
+    """
+    Return for each line id of next_lines the frozenset of the ids of the
+    lines that end the chains starting from it.
+
+    next_lines maps each line id to the ids of its next lines or to None when
+    the chain does not continue. The strongly connected components of the
+    graph are resolved once, so each line is visited a single time whatever
+    the number of chains that go through it.
+    """
+    index = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    result = {}
+    for root in next_lines:
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(next_lines[root] or ()))]
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in index:
+                    index[child] = low[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(next_lines[child] or ())))
+                    break
+                elif child in on_stack:
+                    low[node] = min(low[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] != index[node]:
+                    continue
+                component = set()
+                while True:
+                    line_id = stack.pop()
+                    on_stack.discard(line_id)
+                    component.add(line_id)
+                    if line_id == node:
                         break
-                    income = incoming[key][0]
-
-                    quantity = min(remain_quantity, income['quantity'])
-                    remain_quantity -= quantity
-                    income['quantity'] -= quantity
-                    if income['quantity'] <= 0:
-                        incoming[key].remove(income)
-
-                    ref = income['ref']
-                    lines.append(
-                        StockPlanLine(plan=plan, quantity=quantity,
-                            source=ref, destination=move,
-                            product=move.product,
-                            source_date=(
-                                ref.effective_date or ref.planned_date
-                            ),
-                            destination_date=(
-                                move.effective_date or move.planned_date
-                            )))
-
-                # WITHOUT STOCK: Move without destination
-                if remain_quantity > 0:
-                    lines.append(
-                        StockPlanLine(plan=plan, quantity=remain_quantity,
-                            destination=move, product=move.product,
-                            destination_date=(
-                                move.effective_date or move.planned_date
-                            )))
-
-            # EXCESS STOCK: Create for each existing stock at warehouse
-            if plan.include_excess_stock:
-                lines.extend([
-                    StockPlanLine(plan=plan, quantity=stock_quantity,
-                        source=warehouse, product=Product(key[1]))
-                    for key, stock_quantity in stocks.items()
-                    if key[0] == warehouse.id
-                ])
+                # The components reached from this one are already resolved
+                ends = {i for i in component if next_lines[i] == []}
+                for line_id in component:
+                    for child in next_lines[line_id] or ():
+                        if child not in component:
+                            ends.update(result[child])
+                ends = frozenset(ends)
+                for line_id in component:
+                    result[line_id] = ends
+    return result
+
+
+def allocate_chunk(tasks, include_excess_stock=False):
+    "Allocate a list of (key, stock, outgoing, incoming) tasks"
+    lines = []
+    for key, stock, outgoing, incoming in tasks:
+        lines.extend(
+            allocate(key, stock, outgoing, incoming, include_excess_stock))
+    return lines
+
+
+def insert_plan_rows(Model, plan, names, rows):
+    """
+    Insert the rows as records of Model linked to the plan without
+    instantiating them.
+
+    Each row is a tuple with the values of the field names. The values are
+    converted by the fields, like the quantities truncated to integers, and
+    the rows are written with batched multi-row inserts that fall back to
+    create on backends that do not support them.
+    """
+    transaction = Transaction()
+    cursor = transaction.connection.cursor()
+    table = Model.__table__()
+
+    columns = [table.create_uid, table.create_date, table.plan]
+    columns += [Column(table, name) for name in names]
+    formats = [Model._fields[name].sql_format for name in names]
+    multirow = transaction.database.has_multirow_insert()
+
+    rows = iter(rows)
+    while True:
+        sub_rows = list(islice(rows, backend.MAX_QUERY_PARAMS // len(columns)))
+        if not sub_rows:
+            break
+        if multirow:
+            cursor.execute(*table.insert(columns, [
+                        [transaction.user, CurrentTimestamp(), plan.id,
+                            *(f(v) for f, v in zip(formats, row))]
+                        for row in sub_rows]))
+        else:
+            Model.create([
+                    dict(zip(names, row), plan=plan.id)
+                    for row in sub_rows])
+
+
+class StockPlanProgress(ModelSQL):
+    'Stock Plan Progress'
+    __name__ = 'stock.plan.progress'
 
-        # EXCESS STOCK: Create for each existing incomes
-        if plan.include_excess_stock:
-            lines.extend([
-                StockPlanLine(plan=plan, quantity=income['quantity'],
-                    source=income['ref'], product=income['ref'].product,
-                    source_date=income['ref'].effective_date or income['ref'].planned_date)
-                for incomes in incoming.values()
-                for income in incomes
-            ])
-
-        StockPlanLine.save(lines)
-        plan.lines = lines
-        plan.computed_at = datetime.now()
-        cls.save([plan])
+    plan = fields.Many2One('stock.plan', 'Stock Plan',
+        required=True, ondelete='CASCADE')
+    started_at = fields.DateTime('Started At', required=True)
+    processed_keys = fields.Integer('Processed Keys', required=True)
+    total_keys = fields.Integer('Total Keys', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.__access__.add('plan')
+
+
+class StockPlanLineEnd(ModelSQL):
+    'Stock Plan Line End'
+    __name__ = 'stock.plan.line.end'
+
+    plan = fields.Many2One('stock.plan', 'Stock Plan',
+        required=True, ondelete='CASCADE')
+    line = fields.Many2One('stock.plan.line', 'Line',
+        required=True, ondelete='CASCADE')
+    end_line = fields.Many2One('stock.plan.line', 'End Line',
+        required=True, ondelete='CASCADE')
+    direction = fields.Selection([
+        ('final', 'Final'),
+        ('initial', 'Initial'),
+        ], 'Direction', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls.__access__.add('plan')
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.line, Index.Equality()),
+                    (t.direction, Index.Equality())),
+                })
+
+    @staticmethod
+    def _directions():
+        "Return the directions with the line field that they follow"
+        return [('final', 'to_lines'), ('initial', 'from_lines')]
+
+    @classmethod
+    def bulk_insert(cls, plan, rows):
+        "Insert the (line id, end line id, direction) rows of the plan"
+        insert_plan_rows(cls, plan, ['line', 'end_line', 'direction'], rows)
+
+    @classmethod
+    def get_end_lines(cls, line_ids, name):
+        """
+        Return for the lines of line_ids whose plan has the end lines
+        computed the ids of their end lines following name ('to_lines' or
+        'from_lines').
+        """
+        pool = Pool()
+        StockPlan = pool.get('stock.plan')
+        StockPlanLine = pool.get('stock.plan.line')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        line = StockPlanLine.__table__()
+        plan = StockPlan.__table__()
+
+        direction = dict((n, d) for d, n in cls._directions())[name]
+        result = {}
+        for sub_ids in grouped_slice(line_ids, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*line.join(plan,
+                    condition=line.plan == plan.id
+                    ).join(table, 'LEFT',
+                    condition=(table.line == line.id)
+                    & (table.direction == direction)
+                    ).select(line.id, table.end_line,
+                    where=fields.SQL_OPERATORS['in'](line.id, list(sub_ids))
+                    & (plan.end_lines_computed == Literal(True))))
+            for line_id, end_line_id in cursor:
+                ends = result.setdefault(line_id, [])
+                if end_line_id is not None:
+                    ends.append(end_line_id)
+        return result
 
 
 class StockPlanLine(ModelSQL, ModelView):
     'Stock Plan Line'
     __name__ = 'stock.plan.line'
 
+    warehouse = fields.Many2One('stock.location', 'Warehouse', readonly=True,
+        help='The warehouse where the quantity is allocated.')
     destination = fields.Many2One('stock.move', 'Destination Move')
     destination_date = fields.Date('Destination Date', readonly=True)
-    destination_document = fields.Function(
-        fields.Reference('Destination Document', 'get_document_refs'),
-        'get_document')
-    day_difference = fields.Function(fields.Integer('Days Difference'),
-        'get_day_difference', searcher='search_day_difference')
+    destination_document = fields.Reference('Destination Document',
+        'get_document_refs', readonly=True)
+    day_difference = fields.Integer('Days Difference', readonly=True)
     source = fields.Reference('Source', 'get_source')
     source_date = fields.Date('Source Date', readonly=True)
-    source_document = fields.Function(
-        fields.Reference('Source Document', 'get_document_refs'),
-        'get_document')
+    source_document = fields.Reference('Source Document',
+        'get_document_refs', readonly=True)
     plan = fields.Many2One('stock.plan', 'Stock Plan',
         required=True, ondelete='CASCADE')
     product = fields.Many2One('product.product', 'Product',
@@ -361,54 +1265,252 @@ class StockPlanLine(ModelSQL, ModelView):
     quantity = fields.Integer('Quantity', required=True)
     uom = fields.Function(fields.Many2One('product.uom', 'UoM',
         help='The Unit of Measure for the quantities.'), 'get_uom')
+    _document_refs_cache = Cache('stock.plan.line.get_document_refs')
+    _source_cache = Cache('stock.plan.line.get_source')
 
     @classmethod
     def __setup__(cls):
         super().__setup__()
+        t = cls.__table__()
         cls.__access__.add('plan')
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.plan, Index.Equality()),
+                    (t.day_difference, Index.Range())),
+                Index(t,
+                    (t.plan, Index.Equality()),
+                    (t.destination, Index.Equality())),
+                Index(t,
+                    (t.plan, Index.Equality()),
+                    (t.source, Index.Equality())),
+                Index(t,
+                    (t.plan, Index.Equality()),
+                    (t.product, Index.Equality())),
+                Index(t,
+                    (t.plan, Index.Equality()),
+                    (t.source_document, Index.Equality())),
+                Index(t,
+                    (t.plan, Index.Equality()),
+                    (t.destination_document, Index.Equality())),
+                })
         cls._buttons.update({
             'destination_relate': {},
             'source_relate': {},
         })
 
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        StockPlan = pool.get('stock.plan')
+        StockMove = pool.get('stock.move')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        plan = StockPlan.__table__()
+
+        table_h = cls.__table_handler__(module_name)
+        fill_day_difference = not table_h.column_exist('day_difference')
+        fill_documents = not table_h.column_exist('source_document')
+
+        super().__register__(module_name)
+
+        # Migration from 8.0: store day difference
+        if fill_day_difference:
+            cursor.execute(*table.select(
+                    table.id, table.source_date, table.destination_date,
+                    where=(table.source_date != Null)
+                    & (table.destination_date != Null)))
+            day_differences = defaultdict(list)
+            for line_id, source_date, destination_date in cursor:
+                day_difference = (destination_date - source_date).days
+                day_differences[day_difference].append(line_id)
+            for day_difference, ids in day_differences.items():
+                for sub_ids in grouped_slice(ids, backend.MAX_QUERY_PARAMS):
+                    cursor.execute(*table.update(
+                            [table.day_difference], [day_difference],
+                            where=fields.SQL_OPERATORS['in'](
+                                table.id, list(sub_ids))))
+
+        # Migration from 8.0: store documents
+        if fill_documents:
+            # The lines may still refer to deleted moves
+            move = StockMove.__table__()
+            cursor.execute(*table.join(move,
+                    condition=table.destination == move.id
+                    ).select(table.destination,
+                    group_by=[table.destination]))
+            destinations = [i for i, in cursor]
+            from_move = table.source.like('stock.move,%')
+            cursor.execute(*table.join(move,
+                    condition=from_move & (move.id
+                        == cls.source.sql_id(table.source, StockMove))
+                    ).select(table.source,
+                    where=from_move,
+                    group_by=[table.source]))
+            sources = {int(s.split(',')[1]): s for s, in cursor}
+            documents = cls._get_move_documents(
+                list(set(destinations) | sources.keys()))
+            for column, ref_column, refs in [
+                    (table.destination_document, table.destination,
+                        {i: i for i in destinations}),
+                    (table.source_document, table.source, sources),
+                    ]:
+                document_refs = defaultdict(list)
+                for move_id, ref in refs.items():
+                    if documents[move_id]:
+                        document_refs[documents[move_id]].append(ref)
+                for document, refs in document_refs.items():
+                    for sub_refs in grouped_slice(
+                            refs, backend.MAX_QUERY_PARAMS):
+                        cursor.execute(*table.update([column], [document],
+                                where=fields.SQL_OPERATORS['in'](
+                                    ref_column, list(sub_refs))))
+
+        # Migration from 8.0: store lines count of the plans cleared by
+        # stock.plan
+        cursor.execute(*plan.select(plan.id, where=plan.total_lines == Null))
+        plan_ids = [i for i, in cursor]
+        if plan_ids:
+            counts = StockPlan._count_lines(plan_ids)
+            for plan_id, values in counts.items():
+                cursor.execute(*plan.update(
+                        [Column(plan, n) for n in values],
+                        list(values.values()),
+                        where=plan.id == plan_id))
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        StockPlan = pool.get('stock.plan')
+        lines = super().create(vlist)
+        plan_ids = {l.plan.id for l in lines}
+        StockPlan.update_lines_count(plan_ids)
+        StockPlan.clear_end_lines(plan_ids)
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        StockPlan = pool.get('stock.plan')
+        lines = [l for records in args[::2] for l in records]
+        plan_ids = {l.plan.id for l in lines}
+        super().write(*args)
+        plan_ids.update(l.plan.id for l in cls.browse([l.id for l in lines]))
+        StockPlan.update_lines_count(plan_ids)
+        if any(cls._chain_fields() & values.keys()
+                for values in args[1::2]):
+            StockPlan.clear_end_lines(plan_ids)
+
+    @classmethod
+    def delete(cls, lines):
+        pool = Pool()
+        StockPlan = pool.get('stock.plan')
+        plan_ids = {l.plan.id for l in lines}
+        super().delete(lines)
+        StockPlan.update_lines_count(plan_ids)
+        StockPlan.clear_end_lines(plan_ids)
+
+    @classmethod
+    def _chain_fields(cls):
+        "Return the names of the fields that link the lines into chains"
+        return {'plan', 'source', 'destination', 'source_document',
+            'destination_document'}
+
+    @classmethod
+    def _bulk_fields(cls):
+        "Return the field names of the rows given to bulk_insert"
+        return ['warehouse', 'product', 'quantity', 'source', 'destination',
+            'source_date', 'destination_date', 'day_difference',
+            'source_document', 'destination_document']
+
+    @classmethod
+    def bulk_insert(cls, plan, rows):
+        """
+        Insert the rows as lines of the plan without instantiating records.
+
+        Each row is a tuple with the values of the fields returned by
+        _bulk_fields. The rows are written with batched multi-row inserts
+        and fall back to create on backends that do not support them.
+        """
+        insert_plan_rows(cls, plan, cls._bulk_fields(), rows)
+
     @classmethod
     def get_document_refs(cls):
         pool = Pool()
         Model = pool.get('ir.model')
         StockMove = pool.get('stock.move')
 
+        selection = cls._document_refs_cache.get(None)
+        if selection is not None:
+            return list(selection)
         models = StockMove._get_document_origin() + StockMove._get_document()
         models = Model.search([
                 ('name', 'in', models),
                 ])
-        return [(None, '')] + [(m.name, m.string) for m in models]
+        selection = [(None, '')] + [(m.name, m.string) for m in models]
+        cls._document_refs_cache.set(None, selection)
+        return selection
 
     @classmethod
     def get_source(cls):
         pool = Pool()
         Model = pool.get('ir.model')
+
+        selection = cls._source_cache.get(None)
+        if selection is not None:
+            return list(selection)
         models = Model.search([ ('name', 'in', cls._get_source()) ])
-        return [('', '')] + [(model.name, model.string) for model in models]
+        selection = [('', '')] + [
+            (model.name, model.string) for model in models]
+        cls._source_cache.set(None, selection)
+        return selection
 
     @classmethod
     def _get_source(cls):
         return ['stock.move', 'stock.location']
 
-    def get_document(self, name):
-        if name == 'destination_document':
-            field = self.destination
-        elif name == 'source_document':
-            field = self.source
-        if not (field and hasattr(field, 'document')
-                and hasattr(field, 'document_origin')):
-            return
-        return field.document or field.document_origin
+    @classmethod
+    def bulk_delete(cls, plan, keys=None):
+        """
+        Delete the lines of the plan without instantiating them.
+
+        If keys is set, only the lines of those (warehouse, product) keys are
+        deleted.
+        """
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
 
-    def get_day_difference(self, name):
-        if not self.source_date or not self.destination_date:
+        if keys is None:
+            cursor.execute(*table.delete(where=table.plan == plan.id))
             return
-        day_difference = self.destination_date - self.source_date
-        return day_difference.total_seconds() // (24 * 3600)
+
+        warehouse_products = defaultdict(list)
+        for warehouse_id, product_id in keys:
+            warehouse_products[warehouse_id].append(product_id)
+        for warehouse_id, product_ids in warehouse_products.items():
+            for sub_ids in grouped_slice(
+                    product_ids, backend.MAX_QUERY_PARAMS):
+                cursor.execute(*table.delete(
+                        where=(table.plan == plan.id)
+                        & (table.warehouse == warehouse_id)
+                        & fields.SQL_OPERATORS['in'](
+                            table.product, list(sub_ids))))
+
+    @classmethod
+    def _get_move_documents(cls, move_ids):
+        "Return for each move id its document as a reference string or None"
+        pool = Pool()
+        StockMove = pool.get('stock.move')
+
+        result = dict.fromkeys(move_ids)
+        if not ({'document', 'document_origin'} <= StockMove._fields.keys()):
+            return result
+        # Read the references as strings to not instantiate the moves and
+        # their documents, and share the strings of the same document
+        for values in StockMove.read(
+                list(result), ['document', 'document_origin']):
+            document = values['document'] or values['document_origin']
+            result[values['id']] = sys.intern(document) if document else None
+        return result
 
     def get_uom(self, name):
         if not self.product:
@@ -471,18 +1573,43 @@ class StockPlanLine(ModelSQL, ModelView):
         ])
         return action
 
+
+class StockLocation(metaclass=PoolMeta):
+    __name__ = 'stock.location'
+    _location_warehouses_cache = Cache(
+        'stock.location.location_warehouses', context=False)
+
     @classmethod
-    def search_day_difference(cls, name, clause):
-        table = cls.__table__()
+    def on_modification(cls, mode, locations, field_names=None):
+        super().on_modification(mode, locations, field_names=field_names)
+        cls._location_warehouses_cache.clear()
 
-        _field, operator, value = clause
-        Operator = fields.SQL_OPERATORS[operator]
+    @classmethod
+    def get_location_warehouses(cls):
+        """
+        Return a dictionary mapping each location id to the id of the
+        innermost warehouse that contains it.
+        """
+        warehouses = cls._location_warehouses_cache.get(None)
+        if warehouses is not None:
+            return warehouses
+
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
 
-        day_difference = table.destination_date - table.source_date
+        location = cls.__table__()
+        warehouse = cls.__table__()
 
-        query = (
-            table.select(table.id, where=(Operator(day_difference, value))))
-        return [('id', 'in', query)]
+        # Order by ascending left so the innermost warehouse is the last one
+        cursor.execute(*location.join(warehouse,
+                condition=(warehouse.left <= location.left)
+                & (warehouse.right >= location.right)
+                ).select(location.id, warehouse.id,
+                where=warehouse.type == 'warehouse',
+                order_by=[location.id, warehouse.left.asc]))
+        warehouses = dict(cursor)
+        cls._location_warehouses_cache.set(None, warehouses)
+        return warehouses
 
 
 class StockMixin():
@@ -497,70 +1624,145 @@ class StockMixin():
     initial_lines = fields.Function(fields.Many2Many('stock.plan.line',
         None, None, 'Initial Lines'), 'get_initial_lines')
 
-    def get_final_lines(self, name):
+    @classmethod
+    def _get_moves_lines(cls, records, field, name):
+        """
+        Return for each record the plan lines of name ('to_lines' or
+        'from_lines') of the moves of field, fetched at once for all the
+        records.
+        """
         pool = Pool()
-        PlanLine = pool.get('stock.plan.line')
+        StockMove = pool.get('stock.move')
 
-        lines = set(self.to_lines)
-        visited = set()
-        finals = set()
-        while lines:
-            current = lines.pop()
-            if current in visited:
-                continue
-            visited.add(current)
-            if not current.destination:
-                continue
-            to_lines = current.destination.to_lines
-            if hasattr(current.destination_document, 'to_lines'):
-                to_lines += current.destination_document.to_lines
-            if to_lines:
-                lines.update(to_lines)
-            else:
-                finals.add(current)
-        return PlanLine.browse(list(finals))
+        moves = [m for r in records for m in getattr(r, field)]
+        if name == 'to_lines':
+            lines = StockMove.get_to_lines(moves, name)
+        else:
+            lines = StockMove.get_from_lines(moves, name)
+        return {
+            r.id: [l for m in getattr(r, field) for l in lines[m.id]]
+            for r in records}
 
-    def get_initial_lines(self, name):
+    @classmethod
+    def get_final_lines(cls, records, name):
+        return cls._get_end_lines(records, 'to_lines')
+
+    @classmethod
+    def get_initial_lines(cls, records, name):
+        return cls._get_end_lines(records, 'from_lines')
+
+    @classmethod
+    def _get_end_lines(cls, records, name):
+        """
+        Return for each record the ids of the lines that end the chains of
+        plan lines that start from its lines of name ('to_lines' or
+        'from_lines').
+
+        The end lines stored on activation are used when available.
+        Otherwise the graph is expanded level by level for all the records at
+        once so each level costs a few batched queries instead of one per
+        line.
+        """
         pool = Pool()
         PlanLine = pool.get('stock.plan.line')
+        PlanLineEnd = pool.get('stock.plan.line.end')
+
+        if name == 'to_lines':
+            starts = cls.get_to_lines(records, name)
+        else:
+            starts = cls.get_from_lines(records, name)
+
+        start_ids = {i for ids in starts.values() for i in ids}
+        stored = PlanLineEnd.get_end_lines(list(start_ids), name)
+
+        next_lines = {}
+        frontier = start_ids - stored.keys()
+        while frontier:
+            lines = PlanLine.browse(list(frontier))
+            next_lines.update(cls._get_next_lines(lines, name))
+            frontier = {
+                i for l in lines for i in (next_lines[l.id] or [])
+                if i not in next_lines}
+
+        end_lines = get_end_lines(next_lines)
+        end_lines.update(stored)
+
+        result = {}
+        for record in records:
+            ends = set()
+            for line_id in starts[record.id]:
+                ends.update(end_lines[line_id])
+            result[record.id] = list(ends)
+        return result
+
+    @classmethod
+    def _get_next_lines(cls, lines, name):
+        """
+        Return for each line the ids of the lines of name of its destination
+        ('to_lines') or source ('from_lines') move and document.
+        None is returned for lines that do not continue in that direction.
+        """
+        pool = Pool()
         StockMove = pool.get('stock.move')
 
-        lines = set(self.from_lines)
-        visited = set()
-        initials = set()
-        while lines:
-            current = lines.pop()
-            if current in visited:
-                continue
-            visited.add(current)
-            from_lines = []
-            if isinstance(current.source, StockMove):
-                from_lines += current.source.from_lines
-                if hasattr(current.source_document, 'from_lines'):
-                    from_lines += current.source_document.from_lines
-            if from_lines:
-                lines.update(from_lines)
+        moves = {}
+        documents = defaultdict(set)
+        for line in lines:
+            if name == 'to_lines':
+                move = line.destination
+                document = line.destination_document if move else None
             else:
-                initials.add(current)
-        return PlanLine.browse(list(initials))
+                move = line.source
+                if not isinstance(move, StockMove):
+                    move = None
+                document = line.source_document if move else None
+            if move:
+                moves[line.id] = move
+            if document and name in document._fields:
+                documents[document.__name__].add(document.id)
+
+        if name == 'to_lines':
+            move_lines = StockMove.get_to_lines(
+                list(set(moves.values())), name)
+        else:
+            move_lines = StockMove.get_from_lines(
+                list(set(moves.values())), name)
+
+        document_lines = {}
+        for model, ids in documents.items():
+            Model = pool.get(model)
+            for record in Model.browse(list(ids)):
+                document_lines[str(record)] = [
+                    l.id for l in getattr(record, name)]
+
+        result = {}
+        for line in lines:
+            move = moves.get(line.id)
+            if name == 'to_lines' and not move:
+                result[line.id] = None
+                continue
+            result[line.id] = []
+            if move:
+                result[line.id] += move_lines[move.id]
+                if name == 'to_lines':
+                    document = line.destination_document
+                else:
+                    document = line.source_document
+                if document:
+                    result[line.id] += document_lines.get(str(document), [])
+        return result
 
 
 class Production(StockMixin, metaclass=PoolMeta):
     __name__ = 'production'
 
-    def get_to_lines(self, name):
-        return [
-            line
-            for output in self.outputs
-            for line in output.to_lines
-            ]
+    @classmethod
+    def get_to_lines(cls, productions, name):
+        return cls._get_moves_lines(productions, 'outputs', name)
 
-    def get_from_lines(self, name):
-        return [
-            line
-            for input in self.inputs
-            for line in input.from_lines
-            ]
+    @classmethod
+    def get_from_lines(cls, productions, name):
+        return cls._get_moves_lines(productions, 'inputs', name)
 
 
 class StockMove(StockMixin, metaclass=PoolMeta):
@@ -577,100 +1779,207 @@ class StockMove(StockMixin, metaclass=PoolMeta):
         fields.Many2Many('stock.move', None, None, 'Goes To (Stock Moves)'),
         'get_to_stock_moves')
 
-    def get_party(self, name):
-        pool = Pool()
-        StockShipmentIn = pool.get('stock.shipment.in')
-        StockShipmentInReturn = pool.get('stock.shipment.in.return')
-        StockShipmentOut = pool.get('stock.shipment.out')
-        StockShipmentOutReturn = pool.get('stock.shipment.out.return')
+    @classmethod
+    def _get_party_shipments(cls):
+        "Return the shipment models with the field that holds the party"
+        return {
+            'stock.shipment.out': 'customer',
+            'stock.shipment.out.return': 'customer',
+            'stock.shipment.in': 'supplier',
+            'stock.shipment.in.return': 'supplier',
+            }
 
-        if isinstance(self.shipment, (StockShipmentOut, StockShipmentOutReturn)):
-            return self.shipment.customer
-        elif isinstance(self.shipment, (StockShipmentIn, StockShipmentInReturn)):
-            return self.shipment.supplier
+    @classmethod
+    def get_party(cls, moves, name):
+        pool = Pool()
 
-    def get_to_stock_moves(self, name):
-        records = self.get_to_lines(name)
-        if self.to_location.type == 'production' and self.document:
-            records += self.document.to_lines
-        # Ensure that the *specific* shipment type has the 'to_lines' field.
-        if self.shipment and hasattr(self.shipment, 'to_lines'):
-            records += self.shipment.to_lines
-        return [x.destination for x in records if x.destination]
+        shipment_fields = cls._get_party_shipments()
+        parties = dict.fromkeys([m.id for m in moves])
+        models = defaultdict(list)
+        for move in moves:
+            if move.shipment and move.shipment.__name__ in shipment_fields:
+                models[move.shipment.__name__].append(move)
+
+        for model, model_moves in models.items():
+            Shipment = pool.get(model)
+            field = shipment_fields[model]
+            shipments = Shipment.browse(
+                list({m.shipment.id for m in model_moves}))
+            shipment_parties = {s.id: getattr(s, field) for s in shipments}
+            for move in model_moves:
+                party = shipment_parties[move.shipment.id]
+                parties[move.id] = party.id if party else None
+        return parties
 
-    def get_from_stock_moves(self, name):
+    @classmethod
+    def get_to_stock_moves(cls, moves, name):
         pool = Pool()
-        StockMove = pool.get('stock.move')
+        StockPlanLine = pool.get('stock.plan.line')
 
-        records = self.get_from_lines(name)
-        if self.from_location.type == 'production' and self.document:
-            records += self.document.from_lines
-        # Ensure that the *specific* shipment type has the 'to_lines' field.
-        if self.shipment and hasattr(self.shipment, 'from_lines'):
-            records += self.shipment.from_lines
+        lines = cls._get_document_lines(moves, 'to_lines')
+        destinations = {
+            l.id: l.destination.id
+            for l in StockPlanLine.browse(
+                list({i for ids in lines.values() for i in ids}))
+            if l.destination}
+        return {
+            m: [destinations[i] for i in ids if i in destinations]
+            for m, ids in lines.items()}
 
-        moves = []
-        for record in records:
-            if isinstance(record.source, StockMove):
-                moves.append(record.source)
-        return moves
-
-    def get_to_lines(self, name):
+    @classmethod
+    def get_from_stock_moves(cls, moves, name):
         pool = Pool()
         StockPlanLine = pool.get('stock.plan.line')
 
-        return StockPlanLine.search([
-            self.get_plan_domain(),
-            ('plan.company', '=', self.company.id),
-            ('source', '=', f'stock.move,{self.id}'),
-        ])
+        lines = cls._get_document_lines(moves, 'from_lines')
+        sources = {
+            l.id: l.source.id
+            for l in StockPlanLine.browse(
+                list({i for ids in lines.values() for i in ids}))
+            if isinstance(l.source, cls)}
+        return {
+            m: [sources[i] for i in ids if i in sources]
+            for m, ids in lines.items()}
+
+    @classmethod
+    def _get_document_lines(cls, moves, name):
+        """
+        Return for each move the ids of its plan lines of name ('to_lines' or
+        'from_lines') followed by those of its production and shipment.
+        """
+        pool = Pool()
+
+        if name == 'to_lines':
+            lines = cls.get_to_lines(moves, name)
+            location = 'to_location'
+        else:
+            lines = cls.get_from_lines(moves, name)
+            location = 'from_location'
+
+        documents = defaultdict(set)
+        for move in moves:
+            if (getattr(move, location).type == 'production'
+                    and hasattr(move.document, name)):
+                documents[move.document.__name__].add(move.document.id)
+            # Ensure that the *specific* shipment type has the field.
+            if move.shipment and hasattr(move.shipment, name):
+                documents[move.shipment.__name__].add(move.shipment.id)
+
+        document_lines = {}
+        for model, ids in documents.items():
+            Model = pool.get(model)
+            for record in Model.browse(list(ids)):
+                document_lines[str(record)] = [
+                    l.id for l in getattr(record, name)]
+
+        result = {}
+        for move in moves:
+            result[move.id] = list(lines[move.id])
+            if (getattr(move, location).type == 'production'
+                    and hasattr(move.document, name)):
+                result[move.id] += document_lines[str(move.document)]
+            if move.shipment and hasattr(move.shipment, name):
+                result[move.id] += document_lines[str(move.shipment)]
+        return result
+
+    @classmethod
+    def get_to_lines(cls, moves, name):
+        return cls._get_lines(moves, 'source')
+
+    @classmethod
+    def get_from_lines(cls, moves, name):
+        return cls._get_lines(moves, 'destination')
 
-    def get_from_lines(self, name):
+    @classmethod
+    def _get_lines(cls, moves, field):
+        """
+        Return for each move the ids of the plan lines that have it as field
+        ('source' or 'destination') with one query per company.
+        """
         pool = Pool()
         StockPlanLine = pool.get('stock.plan.line')
 
-        return StockPlanLine.search([
-            self.get_plan_domain(),
-            ('plan.company', '=', self.company.id),
-            ('destination', '=', self.id),
-        ])
+        result = {m.id: [] for m in moves}
+        companies = defaultdict(list)
+        for move in moves:
+            companies[move.company.id].append(move)
+        for company_id, company_moves in companies.items():
+            plan_domain = cls.get_plan_domain(company_id)
+            if plan_domain[2] is None:
+                continue
+            for sub_moves in grouped_slice(
+                    company_moves, backend.MAX_QUERY_PARAMS):
+                if field == 'source':
+                    values = [str(m) for m in sub_moves]
+                else:
+                    values = [m.id for m in sub_moves]
+                lines = StockPlanLine.search([
+                        plan_domain,
+                        (field, 'in', values),
+                        ])
+                for line in lines:
+                    result[getattr(line, field).id].append(line.id)
+        return result
 
     @classmethod
     def search_party(cls, name, clause):
-        return ['OR',
-            ('shipment.customer', *clause[1:], 'stock.shipment.out'),
-            ('shipment.customer', *clause[1:], 'stock.shipment.out.return'),
-            ('shipment.supplier', *clause[1:], 'stock.shipment.in'),
-            ('shipment.supplier', *clause[1:], 'stock.shipment.in.return')]
+        pool = Pool()
+
+        nested = clause[0][len(name):]
+        shipment_type = cls._fields['shipment'].sql_type().base
+        queries = []
+        for model, field in cls._get_party_shipments().items():
+            Shipment = pool.get(model)
+            shipment = Shipment.__table__()
+            query = Shipment.search([
+                    (field + nested, *clause[1:]),
+                    ], order=[], query=True)
+            queries.append(shipment.select(
+                    Concat(model + ',', Cast(shipment.id, shipment_type)),
+                    where=shipment.id.in_(query)))
+        domain = [('shipment', 'in', Union(*queries, all_=True))]
+        # Like a reference path, a negated clause matches moves without
+        # shipment
+        _, operator, value = clause[:3]
+        if ((operator.startswith('not')
+                    and not (operator == 'not in' and None in value))
+                or (operator == '!=' and value is not None)):
+            domain = ['OR', domain, ('shipment', '=', None)]
+        return domain
 
     @classmethod
-    def get_plan_domain(cls):
+    def get_plan(cls, company_id):
+        "Return the id of the plan to read the lines of the company from"
+        pool = Pool()
+        StockPlan = pool.get('stock.plan')
         transaction = Transaction()
         context = transaction.context
 
         active_model = context.get('active_model')
         stock_plan = context.get('stock_plan')
         if active_model == 'stock.plan' and isinstance(stock_plan, int):
-            return ('plan.id', '=', stock_plan)
-        return ('plan.state', '=', 'active')
+            return stock_plan
+        return StockPlan.get_active_plan(company_id)
+
+    @classmethod
+    def get_plan_domain(cls, company_id=None):
+        "Return the domain of the plan lines to read for the company"
+        if company_id is None:
+            company_id = Transaction().context.get('company')
+        # A missing plan gives a domain that matches no line
+        return ('plan', '=', cls.get_plan(company_id))
 
 
 class StockShipmentMixin(StockMixin):
     __slots__ = ()
 
-    def get_to_lines(self, name):
-        return [
-            line
-            for move in self.moves
-            for line in move.to_lines
-        ]
-
-    def get_from_lines(self, name):
-        return [
-            line
-            for move in self.moves
-            for line in move.from_lines
-        ]
+    @classmethod
+    def get_to_lines(cls, shipments, name):
+        return cls._get_moves_lines(shipments, 'moves', name)
+
+    @classmethod
+    def get_from_lines(cls, shipments, name):
+        return cls._get_moves_lines(shipments, 'moves', name)
 
 
 class StockShipmentIn(StockShipmentMixin, metaclass=PoolMeta):
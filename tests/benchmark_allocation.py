@@ -0,0 +1,38 @@
+# This file is part stock_plan module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+"""
+Micro-benchmark of the allocation of a single (warehouse, product) key.
+
+Run it with:
+
+    python -m trytond.modules.stock_plan.tests.benchmark_allocation
+
+The time per move must stay constant when the number of moves grows.
+"""
+import datetime
+import timeit
+
+from trytond.modules.stock_plan.plan import Income, allocate
+
+
+def setup(size):
+    date = datetime.date(2000, 1, 1)
+    outgoing = [(i, 3, date, None) for i in range(size)]
+    incoming = [Income(size + i, 2, date) for i in range(size * 2)]
+    return outgoing, incoming
+
+
+def main():
+    for size in [1_000, 10_000, 100_000]:
+        timer = timeit.Timer(
+            'allocate((1, 1), 10, outgoing, incoming, True)',
+            setup='outgoing, incoming = setup(%s)' % size,
+            globals={'allocate': allocate, 'setup': setup})
+        duration = min(timer.repeat(repeat=3, number=1))
+        print('%7d moves: %8.3f s (%.2f µs/move)' % (
+                size, duration, duration / size * 1e6))
+
+
+if __name__ == '__main__':
+    main()
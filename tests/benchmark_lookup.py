@@ -0,0 +1,91 @@
+# This file is part stock_plan module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+"""
+Benchmark of the plan lines lookups done by the stock move getters.
+
+It fills an in-memory SQLite database with a line table of the given size
+(2 million lines by default) spread over a few plans and measures the
+lookups by source and by destination with and without the indexes
+declared by stock.plan.line.
+
+Run it with:
+
+    python -m trytond.modules.stock_plan.tests.benchmark_lookup [size]
+"""
+import random
+import sqlite3
+import sys
+import timeit
+
+PLANS = 10
+INDEXES = [
+    ('plan', 'destination'),
+    ('plan', 'source'),
+    ('plan', 'product'),
+    ]
+TO_LINES = (
+    'SELECT l.id FROM stock_plan_line AS l '
+    'JOIN stock_plan AS p ON p.id = l.plan '
+    "WHERE p.state = 'active' AND p.company = 1 AND l.source = ?")
+FROM_LINES = (
+    'SELECT l.id FROM stock_plan_line AS l '
+    'JOIN stock_plan AS p ON p.id = l.plan '
+    "WHERE p.state = 'active' AND p.company = 1 AND l.destination = ?")
+
+
+def setup(size):
+    connection = sqlite3.connect(':memory:')
+    cursor = connection.cursor()
+    cursor.execute(
+        'CREATE TABLE stock_plan ('
+        'id INTEGER PRIMARY KEY, company INTEGER, state VARCHAR)')
+    cursor.execute(
+        'CREATE TABLE stock_plan_line ('
+        'id INTEGER PRIMARY KEY, plan INTEGER, product INTEGER, '
+        'quantity INTEGER, source VARCHAR, destination INTEGER)')
+    cursor.executemany('INSERT INTO stock_plan VALUES (?, 1, ?)', [
+            (i, 'active' if i == PLANS else 'deprecated')
+            for i in range(1, PLANS + 1)])
+    moves = size // PLANS
+    cursor.executemany(
+        'INSERT INTO stock_plan_line '
+        '(plan, product, quantity, source, destination) '
+        'VALUES (?, ?, 1, ?, ?)', (
+            (i // moves + 1, i % 1000, 'stock.move,%s' % (i % moves),
+                (i * 7) % moves)
+            for i in range(size)))
+    connection.commit()
+    return connection, moves
+
+
+def measure(cursor, query, values):
+    def lookup():
+        for value in values:
+            cursor.execute(query, (value,)).fetchall()
+    duration = min(timeit.Timer(lookup).repeat(repeat=3, number=1))
+    return duration / len(values)
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000
+    connection, moves = setup(size)
+    cursor = connection.cursor()
+    moves = random.sample(range(moves), 20)
+    sources = ['stock.move,%s' % i for i in moves]
+
+    print('%d lines in %d plans' % (size, PLANS))
+    for label in ['without indexes', 'with indexes']:
+        if label == 'with indexes':
+            for i, columns in enumerate(INDEXES):
+                cursor.execute('CREATE INDEX idx_%s ON stock_plan_line (%s)'
+                    % (i, ', '.join(columns)))
+            cursor.execute('ANALYZE')
+        print('%16s: to_lines %10.3f ms, from_lines %10.3f ms' % (
+                label,
+                measure(cursor, TO_LINES, sources) * 1e3,
+                measure(cursor, FROM_LINES, moves) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,44 @@
 # This file is part stock_plan module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import datetime
+
+from trytond import config
 from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.modules.stock_plan.plan import Income, allocate_chunk
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 
 class StockPlanTestCase(ModuleTestCase, CompanyTestMixin):
     'Test Stock Plan module'
     module = 'stock_plan'
 
+    @with_transaction()
+    def test_allocate_processes(self):
+        'Test allocation by chunks and by a pool of processes'
+        pool = Pool()
+        StockPlan = pool.get('stock.plan')
+
+        def tasks():
+            date = datetime.date(2000, 1, 1)
+            for product_id in range(1, 21):
+                yield ((1, product_id), product_id % 3,
+                    [(product_id * 10 + i, 2, date, None) for i in range(3)],
+                    [Income(product_id * 100 + i, 1, date) for i in range(2)])
+
+        expected = allocate_chunk(list(tasks()), True)
+
+        if not config.has_section('stock_plan'):
+            config.add_section('stock_plan')
+        for processes in ['1', '2']:
+            config.set('stock_plan', 'processes', processes)
+            config.set('stock_plan', 'chunk_size', '3')
+            try:
+                chunks = list(StockPlan._allocate(tasks(), 20, True))
+            finally:
+                config.set('stock_plan', 'processes', '1')
+                config.set('stock_plan', 'chunk_size', '1000')
+            self.assertEqual(sum(c for c, _ in chunks), 20)
+            self.assertEqual([r for _, rows in chunks for r in rows], expected)
+
 del ModuleTestCase
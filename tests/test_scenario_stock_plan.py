@@ -1,7 +1,13 @@
+import csv
+import gzip
+import os
+import shutil
+import tempfile
 import unittest
 from datetime import datetime
 from unittest.mock import patch
 from proteus import Model
+from trytond import config as tryton_config
 from trytond.tests.test_tryton import drop_db
 from trytond.tests.tools import activate_modules
 from trytond.modules.company.tests.tools import create_company, get_company
@@ -24,6 +30,11 @@ class Test(unittest.TestCase):
             return_value=False).start()
         config = activate_modules(['stock', 'stock_plan'])
 
+        # The moves of the test are not written by concurrent transactions
+        if not tryton_config.has_section('stock_plan'):
+            tryton_config.add_section('stock_plan')
+        tryton_config.set('stock_plan', 'changes_margin', '0')
+
         ProductUom = Model.get('product.uom')
         ProductTemplate = Model.get('product.template')
         StockLocation = Model.get('stock.location')
@@ -76,6 +87,10 @@ class Test(unittest.TestCase):
 
         # Create stock plan
         plan = StockPlan(include_excess_stock=True)
+        plan.save()
+        self.assertEqual(plan.total_lines, 0)
+        self.assertEqual(plan.valid_lines, 0)
+        self.assertEqual(plan.without_stock, 0)
 
         def click_do(move):
             try:
@@ -110,6 +125,7 @@ class Test(unittest.TestCase):
         plan.click('calculate')
         plan.reload()
 
+        self.assertFalse(plan.calculating)
         self.assertEqual(len(plan.lines), 1)
         self.assertEqual(plan.lines[0].product, eggs)
         self.assertEqual(plan.lines[0].quantity, 1)
@@ -257,6 +273,19 @@ class Test(unittest.TestCase):
         self.assertEqual(len(salt_storage_line), 1)
         self.assertEqual(salt_storage_line[0].quantity, 100)
 
+            # Check the lines counters
+        self.assertEqual(plan.total_lines, 4)
+        self.assertEqual(plan.valid_lines, 2)
+        self.assertEqual(plan.late_stock, 2)
+        self.assertEqual(plan.without_stock, 0)
+        self.assertEqual(plan.excess_stock, 0)
+
+            # The counters follow the changes of the lines
+        eggs_storage_line[0].delete()
+        plan.reload()
+        self.assertEqual(plan.total_lines, 3)
+        self.assertEqual(plan.valid_lines, 1)
+
         click_do(eggs_move_draft)
         click_do(salt_move_draft)
         click_do(customer_move_eggs)
@@ -442,6 +471,44 @@ class Test(unittest.TestCase):
         self.assertEqual(plan.lines[0].quantity, 1)
         self.assertEqual(plan.lines[0].destination, customer_move)
         self.assertIsNone(plan.lines[0].source)
+        self.assertEqual(plan.total_lines, 1)
+        self.assertEqual(plan.without_stock, 1)
+        self.assertEqual(plan.valid_lines, 0)
+
+            # Only the changed moves are calculated again.
+        other_customer_move, = customer_move.duplicate()
+
+        plan.click('calculate_changes')
+        plan.reload()
+
+        self.assertEqual(len(plan.lines), 2)
+        self.assertEqual(
+            {l.destination for l in plan.lines},
+            {customer_move, other_customer_move})
+        self.assertEqual(plan.total_lines, 2)
+        self.assertEqual(plan.without_stock, 2)
+        self.assertTrue(all(l.source is None for l in plan.lines))
+
+            # The lines of deleted moves are removed.
+        other_customer_move.delete()
+
+        plan.click('calculate_changes')
+        plan.reload()
+
+        self.assertEqual(len(plan.lines), 1)
+        self.assertEqual(plan.lines[0].destination, customer_move)
+
+            # The lines of the previous product of a move are removed.
+        customer_move.product = salt
+        customer_move.save()
+
+        plan.click('calculate_changes')
+        plan.reload()
+
+        self.assertEqual(len(plan.lines), 1)
+        self.assertEqual(plan.lines[0].product, salt)
+        self.assertEqual(plan.lines[0].destination, customer_move)
+        self.assertIsNone(plan.lines[0].source)
 
         customer_move.click('cancel')
 
@@ -685,3 +752,259 @@ class Test(unittest.TestCase):
             unit_price=salt.cost_price,)
         excess_salt_customer.save()
         click_do(excess_salt_customer)
+
+        # CASE 10: Testing the scheduled calculation of plans
+        Cron = Model.get('ir.cron')
+        cron, = Cron.find([
+            ('method', '=', 'stock.plan|calculate_plans'),
+            ('active', '=', False),
+        ])
+        cron.click('run_once')
+
+        scheduled_plan, = StockPlan.find([('state', '=', 'active')])
+        self.assertTrue(scheduled_plan.computed_at)
+        self.assertFalse(scheduled_plan.calculating)
+        self.assertEqual(len(scheduled_plan.lines), 0)
+
+        # Nothing changed
+        cron.click('run_once')
+        self.assertEqual(len(StockPlan.find([('id', '!=', plan.id)])), 1)
+
+        customer_move = StockMove(
+            product=eggs,
+            quantity=1,
+            from_location=storage_location,
+            to_location=customer_location,
+            currency=company.currency,
+            unit_price=Decimal('1.00'),)
+        customer_move.save()
+
+        cron.click('run_once')
+
+        new_plan, = StockPlan.find([('state', '=', 'active')])
+        self.assertNotEqual(new_plan, scheduled_plan)
+        scheduled_plan.reload()
+        self.assertEqual(scheduled_plan.state, 'deprecated')
+        self.assertEqual(len(new_plan.lines), 1)
+        self.assertEqual(new_plan.lines[0].source, warehouse_location)
+        self.assertEqual(new_plan.lines[0].destination, customer_move)
+
+        customer_move.click('cancel')
+
+        # CASE 11: Testing the party of stock moves
+        Party = Model.get('party.party')
+        ShipmentOut = Model.get('stock.shipment.out')
+        output_location, = StockLocation.find([('code', '=', 'OUT')])
+
+        customer = Party(name='Customer')
+        customer.save()
+
+        shipment = ShipmentOut(customer=customer, warehouse=warehouse_location)
+        shipment_move = shipment.outgoing_moves.new()
+        shipment_move.product = eggs
+        shipment_move.unit = unit
+        shipment_move.quantity = 1
+        shipment_move.from_location = output_location
+        shipment_move.to_location = customer_location
+        shipment_move.unit_price = Decimal('1.00')
+        shipment_move.currency = company.currency
+        shipment.save()
+        shipment_move, = shipment.outgoing_moves
+
+        self.assertEqual(shipment_move.party, customer)
+        self.assertIsNone(customer_move.party)
+
+        self.assertEqual(
+            StockMove.find([('party', '=', customer.id)]), [shipment_move])
+        self.assertEqual(
+            StockMove.find([('party', 'ilike', 'cust%')]), [shipment_move])
+        self.assertEqual(
+            StockMove.find([('party.name', 'ilike', 'cust%')]),
+            [shipment_move])
+
+        # Moves without shipment do not have the party
+        other_moves = StockMove.find([('party', '!=', customer.id)])
+        self.assertNotIn(shipment_move, other_moves)
+        self.assertIn(customer_move, other_moves)
+
+        shipment.click('cancel')
+
+        # CASE 12: Testing the traceability of a chain between warehouses
+        # Incoming Moves (to Storage 2): 10g salt
+        # Internal Moves (from Storage 2 to Storage 1): 10g salt
+        # Customer: 10g salt
+        salt_in = StockMove(
+            product=salt,
+            quantity=10,
+            from_location=supplier_location,
+            to_location=storage_copy,
+            currency=company.currency,
+            unit_price=salt.cost_price,)
+        salt_in.save()
+
+        salt_internal = StockMove(
+            product=salt,
+            quantity=10,
+            from_location=storage_copy,
+            to_location=storage_location,)
+        salt_internal.save()
+
+        salt_customer = StockMove(
+            product=salt,
+            quantity=10,
+            from_location=storage_location,
+            to_location=customer_location,
+            currency=company.currency,
+            unit_price=salt.cost_price,)
+        salt_customer.save()
+
+        def check_chain(chain_plan):
+            in_line, = StockPlanLine.find([
+                ('plan', '=', chain_plan.id),
+                ('source', '=', salt_in),
+            ])
+            self.assertEqual(in_line.destination, salt_internal)
+            out_line, = StockPlanLine.find([
+                ('plan', '=', chain_plan.id),
+                ('destination', '=', salt_customer),
+            ])
+            self.assertEqual(out_line.source, salt_internal)
+
+            for move in [salt_in, salt_internal, salt_customer]:
+                move.reload()
+
+            self.assertEqual(list(salt_in.to_lines), [in_line])
+            self.assertEqual(list(salt_in.from_lines), [])
+            self.assertEqual(list(salt_in.final_lines), [out_line])
+            self.assertEqual(list(salt_in.initial_lines), [])
+            self.assertEqual(list(salt_in.to_stock_moves), [salt_internal])
+            self.assertEqual(list(salt_in.from_stock_moves), [])
+
+            self.assertEqual(list(salt_internal.to_lines), [out_line])
+            self.assertEqual(list(salt_internal.from_lines), [in_line])
+            self.assertEqual(list(salt_internal.final_lines), [out_line])
+            self.assertEqual(list(salt_internal.initial_lines), [in_line])
+            self.assertEqual(
+                list(salt_internal.to_stock_moves), [salt_customer])
+            self.assertEqual(list(salt_internal.from_stock_moves), [salt_in])
+
+            self.assertEqual(list(salt_customer.to_lines), [])
+            self.assertEqual(list(salt_customer.from_lines), [out_line])
+            self.assertEqual(list(salt_customer.final_lines), [])
+            self.assertEqual(list(salt_customer.initial_lines), [in_line])
+            self.assertEqual(list(salt_customer.to_stock_moves), [])
+            self.assertEqual(
+                list(salt_customer.from_stock_moves), [salt_internal])
+
+        # The end lines are computed while walking the chain
+        chain_plan = StockPlan()
+        chain_plan.click('calculate')
+        chain_plan.reload()
+        chain_plan.click('activate')
+        chain_plan.reload()
+        self.assertFalse(chain_plan.end_lines_computed)
+        check_chain(chain_plan)
+
+        # The end lines are stored on activation
+        tryton_config.set('stock_plan', 'end_lines', 'True')
+        try:
+            end_lines_plan = StockPlan()
+            end_lines_plan.click('calculate')
+            end_lines_plan.reload()
+            end_lines_plan.click('activate')
+            end_lines_plan.reload()
+        finally:
+            tryton_config.set('stock_plan', 'end_lines', 'False')
+        self.assertTrue(end_lines_plan.end_lines_computed)
+        chain_plan.reload()
+        self.assertEqual(chain_plan.state, 'deprecated')
+        check_chain(end_lines_plan)
+
+        # Editing the lines outdates the stored end lines
+        in_line, = StockPlanLine.find([
+            ('plan', '=', end_lines_plan.id),
+            ('source', '=', salt_in),
+        ])
+        out_line, = StockPlanLine.find([
+            ('plan', '=', end_lines_plan.id),
+            ('destination', '=', salt_customer),
+        ])
+        in_line.destination = None
+        in_line.save()
+        end_lines_plan.reload()
+        self.assertFalse(end_lines_plan.end_lines_computed)
+        salt_in.reload()
+        salt_customer.reload()
+        self.assertEqual(list(salt_in.final_lines), [])
+        self.assertEqual(list(salt_customer.initial_lines), [out_line])
+
+        salt_in.click('cancel')
+        salt_internal.click('cancel')
+        salt_customer.click('cancel')
+
+        # CASE 13: Testing the archive and purge of deprecated plans
+        StockPlanLineEnd = Model.get('stock.plan.line.end')
+
+        end_lines_plan.click('deprecate')
+        self.assertTrue(StockPlanLineEnd.find([
+            ('plan', '=', end_lines_plan.id),
+        ]))
+        chain_lines = StockPlanLine.find([('plan', '=', chain_plan.id)])
+        self.assertTrue(chain_lines)
+
+        purge_cron, = Cron.find([('method', '=', 'stock.plan|purge_plans')])
+        archive_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_path)
+        tryton_config.set('stock_plan', 'archive_path', archive_path)
+        tryton_config.set('stock_plan', 'keep_deprecated', '1')
+        try:
+            purge_cron.click('run_once')
+
+            # The last deprecated plan is kept
+            end_lines_plan.reload()
+            self.assertIsNone(end_lines_plan.purged_at)
+            self.assertTrue(StockPlanLine.find([
+                ('plan', '=', end_lines_plan.id),
+            ]))
+
+            purged_plans = [chain_plan, new_plan, scheduled_plan]
+            for purged_plan in purged_plans:
+                purged_plan.reload()
+                self.assertTrue(purged_plan.purged_at)
+                self.assertEqual(purged_plan.archive_path, os.path.join(
+                        archive_path,
+                        'stock_plan_%s.csv.gz' % purged_plan.id))
+            self.assertEqual(sorted(os.listdir(archive_path)), sorted(
+                    'stock_plan_%s.csv.gz' % p.id for p in purged_plans))
+            self.assertFalse(StockPlanLine.find([
+                ('plan', 'in', [p.id for p in purged_plans]),
+            ]))
+            # The counters are kept for audit
+            self.assertEqual(chain_plan.total_lines, len(chain_lines))
+
+            with gzip.open(chain_plan.archive_path, 'rt', newline='') as file:
+                header, *rows = list(csv.reader(file))
+            self.assertEqual(header[:4],
+                ['id', 'warehouse', 'product', 'quantity'])
+            self.assertEqual(
+                [int(r[0]) for r in rows], sorted(l.id for l in chain_lines))
+
+            # The purged plans are not archived again
+            purged_at = chain_plan.purged_at
+            purge_cron.click('run_once')
+            chain_plan.reload()
+            self.assertEqual(chain_plan.purged_at, purged_at)
+            self.assertEqual(len(os.listdir(archive_path)), 3)
+        finally:
+            tryton_config.remove_section('stock_plan')
+
+        end_lines_plan.click('purge')
+        end_lines_plan.reload()
+        self.assertTrue(end_lines_plan.purged_at)
+        self.assertIsNone(end_lines_plan.archive_path)
+        self.assertFalse(StockPlanLine.find([
+            ('plan', '=', end_lines_plan.id),
+        ]))
+        self.assertFalse(StockPlanLineEnd.find([
+            ('plan', '=', end_lines_plan.id),
+        ]))